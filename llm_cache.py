@@ -0,0 +1,164 @@
+# llm_cache.py
+import time
+import json
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Protocol, Sequence
+
+import numpy as np
+import orjson
+
+
+class CacheBackend(Protocol):
+    """Storage interface for cached LLM results (in-memory today, Redis later)."""
+
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    async def set(self, key: str, value: str) -> None:
+        ...
+
+
+class MemoryCacheBackend:
+    """In-process LRU store with a per-entry TTL."""
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = asyncio.Lock()
+
+    async def get(self, key: str) -> Optional[str]:
+        async with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: str) -> None:
+        async with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class LLMCache:
+    """Content-addressed cache of parsed OpenAI responses.
+
+    Keys are sha256(prompt_version + model + system prompt + user text), so a
+    repeated upload of the same document skips the OpenAI round-trip. The static
+    part is hashed once by `key_prefix`; `make_key` only hashes the user text on
+    top of a copy of it. Values are stored as JSON strings so every hit hands
+    back a fresh dict; they go through stdlib json because model output can hold
+    integers wider than 64 bits, which orjson cannot round-trip.
+    """
+
+    def __init__(self, backend: CacheBackend, prompt_version: str):
+        self.backend = backend
+        self.prompt_version = prompt_version
+
+    def key_prefix(self, model: str, system_prompt: str):
+        """Hash state for the static part of a key; build once per prompt and reuse."""
+        header = orjson.dumps(
+            {"v": self.prompt_version, "model": model, "sys": system_prompt},
+            option=orjson.OPT_SORT_KEYS,
+        )
+        # The JSON header is self-delimiting, so appending the user text stays unambiguous
+        return hashlib.sha256(header)
+
+    def make_key(self, prefix, user_text: str) -> str:
+        key = prefix.copy()
+        key.update(user_text.encode())
+        return key.hexdigest()
+
+    async def get(self, key: str) -> Optional[dict]:
+        value = await self.backend.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def set(self, key: str, value: dict) -> None:
+        await self.backend.set(key, json.dumps(value))
+
+
+class SemanticCache:
+    """Nearest-neighbour cache over document embeddings.
+
+    Embeddings are L2-normalized and stored as rows of one float32 matrix, so a
+    lookup is a single matrix-vector product; the best row is a hit when its
+    cosine similarity reaches `threshold`. This catches near-duplicate uploads
+    (re-scans, OCR whitespace drift) that the exact-hash cache misses. The
+    matrix grows geometrically up to `max_entries` rows and new rows are
+    written in place; once full, the least recently used row is overwritten.
+    `max_entries <= 0` disables the cache. Methods never await, so they are safe to call from the event loop without
+    a lock.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 10000):
+        self.threshold = threshold
+        self.max_entries = max(0, max_entries)
+        self._matrix: Optional[np.ndarray] = None  # (capacity, dim) float32, first _count rows used
+        self._last_used = np.empty(0, dtype=np.int64)
+        self._values = []
+        self._count = 0
+        self._clock = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def lookup(self, embedding: Sequence[float]) -> Optional[dict]:
+        if self._count == 0:
+            return None
+        scores = self._matrix[:self._count] @ _normalize(embedding)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        self._last_used[best] = self._tick()
+        return json.loads(self._values[best])
+
+    def add(self, embedding: Sequence[float], value: dict) -> None:
+        if not self.enabled:
+            return
+        vector = _normalize(embedding)
+        if self._count < self.max_entries:
+            if self._matrix is None or self._count == len(self._matrix):
+                self._grow(len(vector))
+            slot = self._count
+            self._count += 1
+            self._values.append(json.dumps(value))
+        else:
+            slot = int(np.argmin(self._last_used))
+            self._values[slot] = json.dumps(value)
+        self._matrix[slot] = vector
+        self._last_used[slot] = self._tick()
+
+    def _grow(self, dim: int) -> None:
+        capacity = min(self.max_entries, max(64, 2 * self._count))
+        matrix = np.empty((capacity, dim), dtype=np.float32)
+        last_used = np.zeros(capacity, dtype=np.int64)
+        if self._matrix is not None:
+            matrix[:self._count] = self._matrix[:self._count]
+            last_used[:self._count] = self._last_used[:self._count]
+        self._matrix = matrix
+        self._last_used = last_used
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+
+def _normalize(embedding: Sequence[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -1,19 +1,28 @@
 import os
+import json
 import tempfile
 import logging
 import asyncio
-from pathlib import Path
-from typing import List
+from contextlib import asynccontextmanager
+from typing import Callable, List, Optional
 from dotenv import load_dotenv
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import textract_service
 import openai_service
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI(title="Document Analysis API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    textract_service.init_clients()
+    yield
+    textract_service.close_clients()
+    await openai_service.close_client()
+
+app = FastAPI(title="Document Analysis API", lifespan=lifespan)
 logging.basicConfig(level=logging.INFO)
 
 # Configure CORS for development (restrict in production)
@@ -26,74 +35,126 @@ app.add_middleware(
 )
 
 # Allowed file extensions
-ALLOWED_EXTENSIONS = [".pdf", ".docx", ".csv", ".xlsx", ".png", ".jpg", ".jpeg"]
+ALLOWED_EXTENSIONS: frozenset = frozenset({".pdf", ".docx", ".csv", ".xlsx", ".png", ".jpg", ".jpeg"})
+
+# Uploads up to this size stay in memory; larger ones spill over to a temp file on disk
+IN_MEMORY_UPLOAD_LIMIT = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Limit how many files are processed at once, to avoid OpenAI rate-limit bursts
+MAX_CONCURRENT_FILES = int(os.getenv("MAX_CONCURRENT_FILES", "5"))
+file_semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
 
-def validate_file(file: UploadFile):
-    ext = Path(file.filename).suffix.lower()
-    if ext not in ALLOWED_EXTENSIONS:
+# Text extraction is blocking (PDF parsing, OCR calls), so it runs in worker threads, a few at a time
+MAX_CONCURRENT_EXTRACTIONS = int(os.getenv("MAX_CONCURRENT_EXTRACTIONS", str(os.cpu_count() or 4)))
+extraction_semaphore = asyncio.Semaphore(MAX_CONCURRENT_EXTRACTIONS)
+
+def validate_file(suffix: str):
+    """Reject uploads whose (lowercased) extension is not allowed."""
+    if suffix not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=400,
-            detail=f"Unsupported file type: {ext}. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
+            detail=f"Unsupported file type: {suffix}. Allowed types: {', '.join(sorted(ALLOWED_EXTENSIONS))}"
         )
 
-async def process_single_file(file: UploadFile) -> dict:
-    """Process a single file and return analysis results."""
-    tmp_path = None
-    try:
-        validate_file(file)
+async def run_extraction(func, *args, **kwargs) -> str:
+    """Run a blocking textract_service extractor in a worker thread."""
+    async with extraction_semaphore:
+        task = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # The worker may still be reading the caller's spooled file;
+            # let it finish before the file is closed
+            await task
+            raise
 
-        # Save file temporarily to disk
-        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp:
-            file_bytes = await file.read()
-            tmp.write(file_bytes)
-            tmp_path = tmp.name
+async def process_single_file(file: UploadFile, on_progress: Optional[Callable[[str, object], None]] = None) -> dict:
+    """Process a single file and return analysis results.
+
+    Successful results carry the full text under "_full_text" for internal use;
+    callers must pop it before returning the result to a client.
+    If given, `on_progress(event, data)` is called with an "extracted" event once the
+    upload has been read and extracted, then with "delta" events as the analysis streams in.
+    """
+    try:
+        suffix = os.path.splitext(file.filename)[1].lower()
+        validate_file(suffix)
 
         # 1. Extract text using the hybrid service
-        extracted_text = textract_service.extract_text_from_upload(tmp_path, file_bytes)
+        if suffix in textract_service.IN_MEMORY_EXTENSIONS:
+            # Skip the temp file entirely; the parsers and Textract share this one buffer
+            file_bytes = await file.read()
+            extracted_text = await run_extraction(
+                textract_service.extract_text_from_bytes, file_bytes, suffix
+            )
+        else:
+            # Spool the upload: it stays in memory unless it outgrows IN_MEMORY_UPLOAD_LIMIT
+            with tempfile.SpooledTemporaryFile(max_size=IN_MEMORY_UPLOAD_LIMIT, suffix=suffix) as tmp:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    if tmp._rolled or tmp.tell() + len(chunk) > IN_MEMORY_UPLOAD_LIMIT:
+                        # Backed by a real file, or this write triggers the rollover that
+                        # copies the spooled bytes to disk: keep it off the event loop
+                        await asyncio.to_thread(tmp.write, chunk)
+                    else:
+                        tmp.write(chunk)
+                # Hand over the underlying BytesIO or real file: before Python 3.11
+                # SpooledTemporaryFile itself lacks parts of the io API the parsers use
+                tmp.seek(0)
+                extracted_text = await run_extraction(
+                    textract_service.extract_text_from_upload, tmp._file, suffix=suffix
+                )
         if not extracted_text or not extracted_text.strip():
             return {
                 "filename": file.filename,
                 "error": "Failed to extract text from document.",
                 "status": "failed"
             }
+        if on_progress is not None:
+            on_progress("extracted", {"filename": file.filename, "text_length": len(extracted_text)})
+        on_delta = (lambda delta: on_progress("delta", delta)) if on_progress is not None else None
 
-        # 2. Classify the document type
-        classification_result = await openai_service.classify_document(extracted_text)
-        logging.info(f"classification_result type: {type(classification_result)}, value: {classification_result}")
+        # 2. Classify the document type and 3. perform the analysis concurrently.
+        # The analysis prompt detects the document type itself, so it does not
+        # need to wait for the classifier.
+        classification_result, analysis_result = await asyncio.gather(
+            openai_service.classify_document(extracted_text),
+            openai_service.analyze_document_by_type(extracted_text, "unknown", on_delta=on_delta),
+        )
+        logging.info("classification_result type: %s, value: %s", type(classification_result), classification_result)
         if not isinstance(classification_result, dict):
             classification_result = {"document_type": str(classification_result)}
         doc_type = classification_result.get("document_type", "GeneralDocument")
 
-        # 3. Perform specialized analysis
-        analysis_result = await openai_service.analyze_document_by_type(extracted_text, doc_type)
-        
         # ✅ Ensure analysis_result is a dictionary
         if not isinstance(analysis_result, dict):
             logging.warning("OpenAI returned non-dict analysis result. Wrapping it.")
             analysis_result = {"analysis_output": str(analysis_result)}
 
         # ✅ Optional debug logging
-        logging.info(f"analysis_result type: {type(analysis_result)}, value: {analysis_result}")
+        logging.debug("analysis_result type: %s, value: %s", type(analysis_result), analysis_result)
 
         return {
             "filename": file.filename,
             "document_type": doc_type,
             "analysis": analysis_result,
             "status": "success",
-            "extracted_text": extracted_text[:1000]  # Keep first 1000 chars for reference
+            "extracted_text_preview": extracted_text[:1000],  # Keep first 1000 chars for reference
+            "_full_text": extracted_text
         }
 
     except Exception as e:
-        logging.error(f"Error processing file {file.filename}: {e}")
+        logging.error("Error processing file %s: %s", file.filename, e)
         return {
             "filename": file.filename,
             "error": str(e),
             "status": "failed"
         }
-    finally:
-        # Clean up the temporary file
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
+
+async def process_single_file_bounded(file: UploadFile) -> dict:
+    """Process a single file, waiting for a free slot if MAX_CONCURRENT_FILES are already in flight."""
+    async with file_semaphore:
+        return await process_single_file(file)
 
 async def analyze_multiple_files_consolidated(files: List[UploadFile]) -> dict:
     """Analyze multiple files together and provide a single consolidated analysis."""
@@ -103,29 +164,34 @@ async def analyze_multiple_files_consolidated(files: List[UploadFile]) -> dict:
     if len(files) > 10:  # Limit to prevent abuse
         raise HTTPException(status_code=400, detail="Maximum 10 files allowed per request")
     
-    # Process all files to extract text and basic info
+    # Process all files in parallel to extract text and basic info
+    results = await asyncio.gather(*[process_single_file_bounded(file) for file in files])
     file_results = []
-    all_texts = []
+    file_texts = []
     file_info = []
     
-    for file in files:
-        result = await process_single_file(file)
+    for file, result in zip(files, results):
         if result['status'] == 'success':
+            full_text = result.pop('_full_text')
             file_results.append(result)
-            all_texts.append(result['extracted_text'])
+            file_texts.append(full_text)
             file_info.append({
                 "filename": result['filename'],
                 "document_type": result['document_type'],
-                "text_length": len(result['extracted_text'])
+                "text_length": len(full_text)
             })
         else:
-            logging.warning(f"File {file.filename} failed processing: {result.get('error')}")
+            logging.warning("File %s failed processing: %s", file.filename, result.get('error'))
     
     if not file_results:
         raise HTTPException(status_code=422, detail="No files could be processed successfully")
     
-    # Combine all extracted texts for consolidated analysis
-    combined_text = "\n\n--- DOCUMENT SEPARATOR ---\n\n".join(all_texts)
+    # Combine all extracted texts for consolidated analysis, truncating each
+    # document to its share of the prompt budget before joining
+    per_doc_budget = openai_service.CONSOLIDATED_TEXT_BUDGET // len(file_results)
+    combined_text = "\n\n--- DOCUMENT SEPARATOR ---\n\n".join(
+        text[:per_doc_budget] for text in file_texts
+    )
     
     # Perform consolidated analysis using OpenAI
     try:
@@ -144,7 +210,7 @@ async def analyze_multiple_files_consolidated(files: List[UploadFile]) -> dict:
         }
         
     except Exception as e:
-        logging.error(f"Error in consolidated analysis: {e}")
+        logging.error("Error in consolidated analysis: %s", e)
         raise HTTPException(status_code=500, detail=f"Consolidated analysis failed: {str(e)}")
 
 @app.get("/health", status_code=200)
@@ -157,8 +223,60 @@ async def analyze_single(file: UploadFile = File(...)):
     result = await process_single_file(file)
     if result.get("status") == "failed":
         raise HTTPException(status_code=500, detail=result.get("error", "Unknown error"))
+    result.pop("_full_text", None)
     return result
 
+def _sse(event: str, data) -> str:
+    # stdlib json: the analysis may carry integers wider than orjson's 64-bit limit
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/analyze-stream")
+async def analyze_single_stream(file: UploadFile = File(...)):
+    """Analyze a single document, streaming progress and analysis output as server-sent events.
+
+    Emits "extracted", then "delta" events with raw analysis JSON fragments, then a final
+    "result" (same body as /analyze) or "error" event.
+    """
+    events = asyncio.Queue()
+    task = asyncio.create_task(
+        process_single_file(file, on_progress=lambda event, data: events.put_nowait((event, data)))
+    )
+    # FastAPI closes the upload as soon as this handler returns, so wait until it has been read
+    next_event = asyncio.ensure_future(events.get())
+    try:
+        await asyncio.wait({next_event, task}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        # Client went away before the upload was read: don't keep paying for the analysis
+        task.cancel()
+        next_event.cancel()
+        raise
+
+    async def event_stream():
+        nonlocal next_event
+        try:
+            while True:
+                await asyncio.wait({next_event, task}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_event.done():
+                    next_event.cancel()
+                    break
+                event, data = next_event.result()
+                yield _sse(event, data)
+                next_event = asyncio.ensure_future(events.get())
+            while not events.empty():
+                event, data = events.get_nowait()
+                yield _sse(event, data)
+            result = task.result()
+            result.pop("_full_text", None)
+            yield _sse("result" if result.get("status") == "success" else "error", result)
+        finally:
+            # Runs when Starlette closes the stream on client disconnect; stop the
+            # OpenAI calls nobody is listening to
+            if not task.done():
+                task.cancel()
+            next_event.cancel()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.post("/analyze-multiple")
 async def analyze_multiple(files: List[UploadFile] = File(...)):
     """Analyze multiple documents individually (separate analysis for each)."""
@@ -169,7 +287,7 @@ async def analyze_multiple(files: List[UploadFile] = File(...)):
         raise HTTPException(status_code=400, detail="Maximum 10 files allowed per request")
     
     # Process all files in parallel
-    tasks = [process_single_file(file) for file in files]
+    tasks = [process_single_file_bounded(file) for file in files]
     results = await asyncio.gather(*tasks, return_exceptions=True)
     
     # Handle any exceptions that occurred during processing
@@ -182,6 +300,7 @@ async def analyze_multiple(files: List[UploadFile] = File(...)):
                 "status": "failed"
             })
         else:
+            result.pop("_full_text", None)
             processed_results.append(result)
     
     # Count successes and failures
@@ -2,139 +2,242 @@
 import os
 import json
 import logging
+from typing import Callable, Optional
+import httpx
+import orjson
+import openai
+import tiktoken
 from openai import AsyncOpenAI
-from prompts import CLASSIFICATION_PROMPT, ANALYSIS_PROMPTS
-
-# Load OpenAI credentials
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from tenacity import AsyncRetrying, before_sleep_log, retry_if_exception, stop_after_attempt, wait_random_exponential
+from llm_cache import LLMCache, MemoryCacheBackend, SemanticCache
+from prompts import PROMPT_VERSION, CLASSIFICATION_PROMPT, ANALYSIS_PROMPTS, CONSOLIDATED_SYSTEM, CONSOLIDATED_USER_TEMPLATE
+
+# Shared HTTP/2 connection pool so concurrent requests reuse warm TLS connections
+shared_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+    timeout=httpx.Timeout(120.0, connect=5.0),
+)
+
+# Load OpenAI credentials (retries are handled by _chat_completion, not the SDK)
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=shared_http, max_retries=0)
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
 MAX_RETRIES = 3
-
-async def classify_document(text: str) -> dict:
-    """Step 1: Classify the document type with retries."""
-    logging.info("Classifying document type...")
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            logging.info(f"Attempt {attempt}: Sending classification request to OpenAI...")
-            response = await client.chat.completions.create(
-                model=OPENAI_MODEL,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": CLASSIFICATION_PROMPT},
-                    {"role": "user", "content": text[:4000]}
-                ],
-                temperature=0.2
-            )
-            result = json.loads(response.choices[0].message.content)
-
-            if isinstance(result, dict) and 'document_type' in result:
-                return {"document_type": result['document_type']}
-            else:
-                logging.warning("Unexpected classification format.")
-                return {"document_type": str(result)}
-
-        except Exception as e:
-            logging.warning(f"Attempt {attempt} failed: {e}")
-    logging.error("All classification attempts failed.")
-    return {"document_type": "GeneralDocument"}
-
-async def analyze_document_by_type(text: str, doc_type: str) -> dict:
-    """Step 2: Analyze the document using a universal analysis prompt with retries."""
-    logging.info(f"Analyzing document. Type: {doc_type}")
-    for attempt in range(1, MAX_RETRIES + 1):
+# Only transient failures are retried: rate limits, network errors (including drops
+# mid-stream, which surface as raw httpx errors) and 5xx responses
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError, httpx.TransportError)
+# Characters of combined document text sent for consolidated analysis (split across documents by the caller)
+CONSOLIDATED_TEXT_BUDGET = 8000
+# Tokens of document text sent per call; classification only needs the head of the document
+CLASSIFICATION_MAX_TOKENS = 400
+ANALYSIS_MAX_TOKENS = 6000
+
+def _load_encoding():
+    """Tokenizer for OPENAI_MODEL, or None if tiktoken cannot provide one (e.g. offline)."""
+    try:
         try:
-            logging.info(f"Attempt {attempt}: Sending analysis request to OpenAI...")
-            response = await client.chat.completions.create(
+            return tiktoken.encoding_for_model(OPENAI_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")  # GPT-4o family tokenizer
+    except Exception as e:
+        logging.warning("tiktoken unavailable, truncating prompts by characters instead: %s", e)
+        return None
+
+_ENC = _load_encoding()
+# A token is rarely longer than this, so text is pre-sliced before encoding to bound the work
+_MAX_CHARS_PER_TOKEN = 10
+
+def _trim(text: str, max_tokens: int) -> str:
+    """Truncate text to at most `max_tokens` model tokens."""
+    text = text[:max_tokens * _MAX_CHARS_PER_TOKEN]
+    if _ENC is None:
+        return text[:max_tokens * 4]
+    tokens = _ENC.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return _ENC.decode(tokens[:max_tokens])
+
+# Response cache for classification/analysis (identical prompt + text => identical result)
+llm_cache = LLMCache(
+    MemoryCacheBackend(
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000")),
+        ttl_seconds=float(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    ),
+    prompt_version=PROMPT_VERSION,
+)
+
+# Static message parts and cache-key prefixes, built once at import rather than per request
+_CLASSIFY_SYSTEM_MESSAGE = {"role": "system", "content": CLASSIFICATION_PROMPT}
+_ANALYSIS_SYSTEM_MESSAGE = {"role": "system", "content": ANALYSIS_PROMPTS}
+_CONSOLIDATED_SYSTEM_MESSAGE = {"role": "system", "content": CONSOLIDATED_SYSTEM}
+_CLASSIFY_KEY_PREFIX = llm_cache.key_prefix(OPENAI_MODEL, CLASSIFICATION_PROMPT)
+_ANALYSIS_KEY_PREFIX = llm_cache.key_prefix(OPENAI_MODEL, ANALYSIS_PROMPTS)
+
+# Embedding-similarity cache for classification only: reusing a near-duplicate's
+# document type is safe, reusing its analysis (exact amounts, numbers) is not
+EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+# 0 turns the semantic cache off (no embedding calls)
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+classification_semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES)
+
+async def close_client():
+    """Close the shared HTTP connection pool. Called on application shutdown."""
+    await shared_http.aclose()
+
+async def embed_text(text: str) -> Optional[list]:
+    """Embed text for semantic cache lookups. Returns None if unavailable."""
+    try:
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        return response.data[0].embedding
+    except Exception as e:
+        logging.warning("Embedding request failed, skipping semantic cache: %s", e)
+        return None
+
+async def _chat_completion(label: str, on_delta: Optional[Callable[[str], None]] = None, **kwargs) -> str:
+    """Stream a JSON-mode chat completion and return the full content.
+
+    Each content delta is passed to `on_delta` as it arrives. Transient errors are
+    retried with exponential backoff and jitter, but only until the first delta has
+    been forwarded: a retry restarts the stream, which would repeat output already sent.
+    """
+    forwarded = False
+
+    def should_retry(exc: BaseException) -> bool:
+        return isinstance(exc, RETRYABLE_ERRORS) and not forwarded
+
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(MAX_RETRIES),
+        wait=wait_random_exponential(multiplier=0.5, max=8),
+        retry=retry_if_exception(should_retry),
+        before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+        reraise=True,
+    ):
+        with attempt:
+            logging.info("Attempt %d: Sending %s request to OpenAI...", attempt.retry_state.attempt_number, label)
+            stream = await client.chat.completions.create(
                 model=OPENAI_MODEL,
                 response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": ANALYSIS_PROMPTS},
-                    {"role": "user", "content": text}
-                ],
-                temperature=0.2
+                stream=True,
+                **kwargs
             )
-            content = response.choices[0].message.content.strip()
-            logging.debug(f"OpenAI response: {content}")
-            result = json.loads(content)
+            chunks = []
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    chunks.append(delta)
+                    if on_delta is not None:
+                        forwarded = True
+                        on_delta(delta)
+    return "".join(chunks).strip()
 
-            if isinstance(result, dict):
-                return result
-            else:
-                logging.warning("Unexpected analysis format.")
-                return {"result": str(result)}
-
-        except Exception as e:
-            logging.warning(f"Attempt {attempt} failed: {e}")
-    logging.error("All analysis attempts failed.")
-    return {"error": "Failed to analyze document."}
+async def classify_document(text: str) -> dict:
+    """Step 1: Classify the document type, retrying transient OpenAI errors."""
+    logging.info("Classifying document type...")
+    user_text = _trim(text, CLASSIFICATION_MAX_TOKENS)
+    cache_key = llm_cache.make_key(_CLASSIFY_KEY_PREFIX, user_text)
+    cached = await llm_cache.get(cache_key)
+    if cached is not None:
+        logging.info("Classification cache hit.")
+        return cached
+    # Embed exactly what the model would see, so a hit means a near-identical prompt
+    embedding = await embed_text(user_text) if classification_semantic_cache.enabled else None
+    if embedding is not None:
+        similar = classification_semantic_cache.lookup(embedding)
+        if similar is not None:
+            logging.info("Classification semantic cache hit.")
+            return similar
+
+    try:
+        content = await _chat_completion(
+            "classification",
+            messages=[
+                _CLASSIFY_SYSTEM_MESSAGE,
+                {"role": "user", "content": user_text}
+            ],
+            temperature=0.2
+        )
+        result = json.loads(content)
+    except Exception as e:
+        logging.error("Classification failed: %s", e)
+        return {"document_type": "GeneralDocument"}
+
+    if isinstance(result, dict) and 'document_type' in result:
+        classification = {"document_type": result['document_type']}
+        await llm_cache.set(cache_key, classification)
+        if embedding is not None:
+            classification_semantic_cache.add(embedding, classification)
+        return classification
+    else:
+        logging.warning("Unexpected classification format.")
+        return {"document_type": str(result)}
+
+async def analyze_document_by_type(text: str, doc_type: str, on_delta: Optional[Callable[[str], None]] = None) -> dict:
+    """Step 2: Analyze the document using a universal analysis prompt, retrying transient OpenAI errors.
+
+    If given, `on_delta` receives the raw JSON output as it streams in (not called on cache hits).
+    """
+    logging.info("Analyzing document. Type: %s", doc_type)
+    user_text = _trim(text, ANALYSIS_MAX_TOKENS)
+    cache_key = llm_cache.make_key(_ANALYSIS_KEY_PREFIX, user_text)
+    cached = await llm_cache.get(cache_key)
+    if cached is not None:
+        logging.info("Analysis cache hit.")
+        return cached
+
+    try:
+        content = await _chat_completion(
+            "analysis",
+            on_delta=on_delta,
+            messages=[
+                _ANALYSIS_SYSTEM_MESSAGE,
+                {"role": "user", "content": user_text}
+            ],
+            temperature=0.2
+        )
+        logging.debug("OpenAI response: %s", content)
+        result = json.loads(content)
+    except Exception as e:
+        logging.error("Analysis failed: %s", e)
+        return {"error": "Failed to analyze document."}
+
+    if isinstance(result, dict):
+        await llm_cache.set(cache_key, result)
+        return result
+    else:
+        logging.warning("Unexpected analysis format.")
+        return {"result": str(result)}
 
 async def analyze_multiple_documents_consolidated(combined_text: str, file_info: list) -> dict:
     """Analyze multiple documents together and provide a single consolidated analysis."""
-    logging.info(f"Performing consolidated analysis of {len(file_info)} documents")
-    
-    # Create a detailed prompt for consolidated analysis focusing on summaries and recommendations
-    consolidated_prompt = f"""
-You are an expert document analyst specializing in providing detailed summaries and actionable recommendations. You have been given {len(file_info)} documents to analyze together.
-
-Your task is to provide a comprehensive analysis with detailed summaries and specific, actionable recommendations:
-
-1. **Comprehensive Summary**: Detailed summary of all documents combined with specific details, amounts, dates, and entities
-2. **Key Findings**: Specific, actionable findings from the document collection
-3. **Detailed Recommendations**: Specific, actionable recommendations with exact details and next steps
-4. **Priority Actions**: Most urgent or important actions that need immediate attention with specific details
-
-Document Information:
-{json.dumps(file_info, indent=2)}
-
-Please provide a clean JSON response with these fields:
-{{
-    "comprehensive_summary": "Detailed summary of all documents combined with specific details, amounts, dates, company names, and exact information",
-    "key_findings": [
-        "Specific finding 1 with exact details",
-        "Specific finding 2 with exact details"
-    ],
-    "detailed_recommendations": [
-        "Specific recommendation 1 with exact details (e.g., 'Pay invoice 250270334 for €91.25 issued by KvK by December 15th')",
-        "Specific recommendation 2 with exact details (e.g., 'Contact legal team regarding contract ABC-2024-001 renewal by November 30th')",
-        "Specific recommendation 3 with exact details (e.g., 'Verify purchase order PO-2024-001 matches invoice amount of €2,450.00')"
-    ],
-    "priority_actions": [
-        "Most urgent action 1 with exact details and deadlines",
-        "Most urgent action 2 with exact details and deadlines"
-    ]
-}}
-
-Analyze the following combined text from all documents:
-{combined_text[:8000]}  # Limit to prevent token overflow
-
-IMPORTANT: Focus on providing SPECIFIC, DETAILED summaries and recommendations rather than general statements. Include exact invoice numbers, amounts, company names, dates, and other specific details that make the recommendations immediately actionable.
-"""
-
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            logging.info(f"Attempt {attempt}: Sending consolidated analysis request to OpenAI...")
-            response = await client.chat.completions.create(
-                model=OPENAI_MODEL,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": "You are an expert document analyst specializing in multi-document analysis and providing detailed summaries with actionable recommendations. Focus on specific details and concrete guidance."},
-                    {"role": "user", "content": consolidated_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=3000
-            )
-            content = response.choices[0].message.content.strip()
-            logging.debug(f"OpenAI consolidated analysis response: {content}")
-            result = json.loads(content)
-
-            if isinstance(result, dict):
-                return result
-            else:
-                logging.warning("Unexpected consolidated analysis format.")
-                return {"comprehensive_summary": "Analysis completed but format was unexpected", "detailed_recommendations": ["Please check document format"]}
-
-        except Exception as e:
-            logging.warning(f"Attempt {attempt} failed: {e}")
+    logging.info("Performing consolidated analysis of %d documents", len(file_info))
     
-    logging.error("All consolidated analysis attempts failed.")
-    return {"comprehensive_summary": "Failed to analyze documents", "detailed_recommendations": ["Please try again or check document format"]}
+    consolidated_prompt = CONSOLIDATED_USER_TEMPLATE.format(
+        n=len(file_info),
+        file_info_json=orjson.dumps(file_info).decode(),
+        combined_text=combined_text,
+    )
+
+    try:
+        content = await _chat_completion(
+            "consolidated analysis",
+            messages=[
+                _CONSOLIDATED_SYSTEM_MESSAGE,
+                {"role": "user", "content": consolidated_prompt}
+            ],
+            temperature=0.3,
+            max_tokens=3000
+        )
+        logging.debug("OpenAI consolidated analysis response: %s", content)
+        result = json.loads(content)
+    except Exception as e:
+        logging.error("Consolidated analysis failed: %s", e)
+        return {"comprehensive_summary": "Failed to analyze documents", "detailed_recommendations": ["Please try again or check document format"]}
+
+    if isinstance(result, dict):
+        return result
+    else:
+        logging.warning("Unexpected consolidated analysis format.")
+        return {"comprehensive_summary": "Analysis completed but format was unexpected", "detailed_recommendations": ["Please check document format"]}
@@ -1,5 +1,8 @@
 # prompts.py
 
+# Bump whenever a prompt below changes so cached LLM responses are invalidated
+PROMPT_VERSION = "v2"
+
 # Step 1: For initial classification (lightweight)
 CLASSIFICATION_PROMPT = """
 Analyze the following text to identify the document type. Respond ONLY with a JSON object 
@@ -49,3 +52,37 @@ Rules:
 - Provide concrete, actionable guidance with exact details
 """
 
+# Step 3: For consolidated multi-document analysis. The system prompt is static so
+# OpenAI can reuse its cached prefix; only the user message varies per request.
+CONSOLIDATED_SYSTEM = """
+You are an expert document analyst specializing in multi-document analysis and providing detailed summaries with actionable recommendations. You will be given information about several documents followed by their combined text, to analyze together.
+
+Your task is to provide a comprehensive analysis with detailed summaries and specific, actionable recommendations:
+
+1. **Comprehensive Summary**: Detailed summary of all documents combined with specific details, amounts, dates, and entities
+2. **Key Findings**: Specific, actionable findings from the document collection
+3. **Detailed Recommendations**: Specific, actionable recommendations with exact details and next steps
+4. **Priority Actions**: Most urgent or important actions that need immediate attention with specific details
+
+Please provide a clean JSON response with these fields:
+{
+    "comprehensive_summary": "Detailed summary of all documents combined with specific details, amounts, dates, company names, and exact information",
+    "key_findings": [
+        "Specific finding 1 with exact details",
+        "Specific finding 2 with exact details"
+    ],
+    "detailed_recommendations": [
+        "Specific recommendation 1 with exact details (e.g., 'Pay invoice 250270334 for €91.25 issued by KvK by December 15th')",
+        "Specific recommendation 2 with exact details (e.g., 'Contact legal team regarding contract ABC-2024-001 renewal by November 30th')",
+        "Specific recommendation 3 with exact details (e.g., 'Verify purchase order PO-2024-001 matches invoice amount of €2,450.00')"
+    ],
+    "priority_actions": [
+        "Most urgent action 1 with exact details and deadlines",
+        "Most urgent action 2 with exact details and deadlines"
+    ]
+}
+
+IMPORTANT: Focus on providing SPECIFIC, DETAILED summaries and recommendations rather than general statements. Include exact invoice numbers, amounts, company names, dates, and other specific details that make the recommendations immediately actionable.
+"""
+
+CONSOLIDATED_USER_TEMPLATE = "Documents ({n}):\n{file_info_json}\n\nCombined text:\n{combined_text}"
@@ -4,6 +4,7 @@ load_dotenv()
 import os
 import logging
 import boto3
+from botocore.config import Config
 import pdfplumber
 import pandas as pd
 from docx import Document
@@ -11,95 +12,140 @@ from PIL import Image
 from io import BytesIO
 from botocore.exceptions import ClientError, NoRegionError, NoCredentialsError
 
-# Initialize AWS Textract client conditionally
+# Shared AWS Textract client, created once at application startup by init_clients()
 textract_client = None
-try:
-    if (os.getenv("AWS_ACCESS_KEY_ID") and 
-        os.getenv("AWS_SECRET_ACCESS_KEY") and 
-        os.getenv("AWS_REGION")):
-        
-        textract_client = boto3.client(
-            "textract",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            region_name=os.getenv("AWS_REGION")
-        )
-        logging.info("AWS Textract client initialized successfully")
-    else:
-        logging.warning("AWS credentials not found. Textract OCR will not be available.")
-        logging.warning("Set AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, and AWS_REGION environment variables")
-except Exception as e:
-    logging.warning(f"Failed to initialize AWS Textract client: {e}")
-    textract_client = None
 
-def extract_text_from_upload(file_path: str, file_bytes: bytes) -> str:
-    """Extracts text from various formats. Falls back to AWS Textract OCR for scanned documents/images."""
+# One connection pool shared by all requests; adaptive retries back off on throttling
+TEXTRACT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+)
+
+def init_clients():
+    """Initialize the AWS Textract client conditionally. Called from the FastAPI lifespan."""
+    global textract_client
+    try:
+        if (os.getenv("AWS_ACCESS_KEY_ID") and 
+            os.getenv("AWS_SECRET_ACCESS_KEY") and 
+            os.getenv("AWS_REGION")):
+            
+            textract_client = boto3.client(
+                "textract",
+                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                region_name=os.getenv("AWS_REGION"),
+                config=TEXTRACT_CONFIG
+            )
+            logging.info("AWS Textract client initialized successfully")
+        else:
+            logging.warning("AWS credentials not found. Textract OCR will not be available.")
+            logging.warning("Set AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, and AWS_REGION environment variables")
+    except Exception as e:
+        logging.warning("Failed to initialize AWS Textract client: %s", e)
+        textract_client = None
+
+def close_clients():
+    """Release the Textract client's connection pool. Called on application shutdown."""
+    global textract_client
+    if textract_client is not None:
+        textract_client.close()
+        textract_client = None
+
+# Formats that are parsed entirely in memory anyway (images go to Textract as bytes),
+# so they never need a temp file whatever their size
+IN_MEMORY_EXTENSIONS = frozenset({".csv", ".png", ".jpg", ".jpeg"})
 
-    ext = file_path.lower()
+def _read_bytes(source) -> bytes:
+    """Read the full upload from a path or a binary file object."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return f.read()
+    source.seek(0)
+    return source.read()
+
+def extract_text_from_upload(source, file_bytes: bytes = None, suffix: str = None) -> str:
+    """Extracts text from various formats. Falls back to AWS Textract OCR for scanned documents/images.
+
+    `source` is a file path or a seekable binary file object (pass `suffix` for the latter).
+    `file_bytes` is only needed for OCR and is read from `source` on demand when omitted.
+    """
+
+    ext = (suffix or str(source)).lower()
 
     # 1. Extract text from digital PDFs
     if ext.endswith(".pdf"):
         try:
-            with pdfplumber.open(file_path) as pdf:
+            with pdfplumber.open(source) as pdf:
                 full_text = "".join(page.extract_text() or "" for page in pdf.pages)
             if full_text.strip():
                 logging.info("Successfully extracted text using pdfplumber.")
                 return full_text.strip()
         except Exception as e:
-            logging.warning(f"pdfplumber failed: {e}. Falling back to Textract.")
+            logging.warning("pdfplumber failed: %s. Falling back to Textract.", e)
 
     # 2. Extract text from Word documents (.docx)
     elif ext.endswith(".docx"):
         try:
-            doc = Document(file_path)
+            doc = Document(source)
             full_text = "\n".join([para.text for para in doc.paragraphs])
             if full_text.strip():
                 logging.info("Successfully extracted text from DOCX.")
                 return full_text.strip()
         except Exception as e:
-            logging.warning(f"python-docx failed: {e}. Falling back to Textract.")
+            logging.warning("python-docx failed: %s. Falling back to Textract.", e)
 
     # 3. Extract from Excel and CSV (.xlsx, .csv)
     elif ext.endswith(".xlsx") or ext.endswith(".csv"):
         try:
             if ext.endswith(".csv"):
-                df = pd.read_csv(file_path)
+                df = pd.read_csv(source)
             else:
-                df = pd.read_excel(file_path)
+                df = pd.read_excel(source)
             full_text = df.to_string(index=False)
             if full_text.strip():
                 logging.info("Successfully extracted text from Excel/CSV.")
                 return full_text.strip()
         except Exception as e:
-            logging.warning(f"pandas failed to extract table: {e}. Falling back to Textract.")
+            logging.warning("pandas failed to extract table: %s. Falling back to Textract.", e)
 
     # 4. Extract from images (.png, .jpg, .jpeg)
     elif ext.endswith((".png", ".jpg", ".jpeg")):
         try:
+            if file_bytes is None:
+                file_bytes = _read_bytes(source)
             image = Image.open(BytesIO(file_bytes))
             if image.mode != "RGB":
                 image = image.convert("RGB")
             logging.info("Image opened successfully. Using Textract.")
             # Skip PIL OCR — go directly to Textract for better multilingual OCR
         except Exception as e:
-            logging.warning(f"PIL failed to open image: {e}. Falling back to Textract.")
+            logging.warning("PIL failed to open image: %s. Falling back to Textract.", e)
 
     # 5. Fallback: AWS Textract (for scans, images, poor PDFs)
     if textract_client is not None:
         logging.info("Using AWS Textract for OCR extraction.")
         try:
+            if file_bytes is None:
+                file_bytes = _read_bytes(source)
             response = textract_client.detect_document_text(
                 Document={"Bytes": file_bytes}
             )
             text_blocks = [block['Text'] for block in response['Blocks'] if block['BlockType'] == 'LINE']
             return "\n".join(text_blocks)
         except ClientError as e:
-            logging.error(f"AWS Textract API error: {e}")
+            logging.error("AWS Textract API error: %s", e)
             return ""
         except Exception as e:
-            logging.error(f"Unexpected Textract error: {e}")
+            logging.error("Unexpected Textract error: %s", e)
             return ""
     else:
         logging.error("AWS Textract not available. Cannot process scanned documents or images.")
         logging.error("Please configure AWS credentials and region to enable OCR functionality.")
         return ""
+
+def extract_text_from_bytes(file_bytes: bytes, suffix: str) -> str:
+    """Extracts text from an in-memory upload without touching disk.
+
+    BytesIO shares the buffer of a `bytes` object, so the upload is not copied.
+    """
+    return extract_text_from_upload(BytesIO(file_bytes), file_bytes, suffix=suffix)